@@ -1,24 +1,34 @@
 """Retrieve, process and save buoycam images and buoy observation datat from the NOAA"""
 
 import argparse
+import asyncio
 import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+import hashlib
+from io import BytesIO, StringIO
 import logging
 import os
-import threading
+import sqlite3
 import time
-from typing import Dict, List
+from typing import Awaitable, Dict, List, Optional, Tuple, TypeVar
 import json
 
-import requests
+import aiohttp
+from aiolimiter import AsyncLimiter
 
 # import matplotlib.pyplot as plt
 from PIL import Image
 import numpy as np
+import pandas as pd
 import easyocr
+from easyocr.recognition import get_text
+from easyocr.utils import get_image_list
 
 import seesea.utils as utils
+from seesea.fast_ops import tile_black_fractions
 from seesea.observation import Observation
+from seesea.onnx_ocr import RECOGNIZER_IMAGE_HEIGHT, OnnxRecognizer
 
 BUOYCAM_LIST_URL = "https://www.ndbc.noaa.gov/buoycams.php"
 BUOYCAM_IMAGE_FILE_URL_BASE = "https://www.ndbc.noaa.gov/images/buoycam"
@@ -32,17 +42,58 @@ SUB_IMAGE_HEIGHT = 270
 
 FRACTION_BLACK_THRESHOLD = 0.85
 
+# Region of the full image containing the bearing of the first sub image
+ANGLE_CROP_LEFT = 150
+ANGLE_CROP_WIDTH = 100
+ANGLE_CROP_HEIGHT = 30
+
+# Number of angle crops to run through the OCR reader at once
+OCR_BATCH_SIZE = 32
+
+# Default path of the cache of angles read from angle crops
+ANGLE_CACHE_PATH = os.path.join("cache", "angle_ocr.db")
+
+# Max number of crop hashes to look up in the angle cache per query
+ANGLE_CACHE_QUERY_SIZE = 500
+
+# Bytes of the recognizer model file read at a time when hashing it
+MODEL_HASH_CHUNK_SIZE = 1 << 20
+
 MISSING_DATA_INDICATOR = "MM"
 
-# Rate limiting lock to be nice to the NOAA buoycam website
-request_rate_limit_lock = threading.Lock()
-# Max requests per second
+# Observation table columns the observation timestamp is built from
+TIMESTAMP_TABLE_COLUMNS = ["YY", "MM", "DD", "hh", "mm"]
+
+# Observation table columns and the observation attributes they are stored as
+OBSERVATION_TABLE_COLUMNS = {
+    "WSPD": "wind_speed_mps",
+    "WDIR": "wind_direction_deg",
+    "GST": "gust_speed_mps",
+    "WVHT": "wave_height_m",
+    "DPD": "dominant_wave_period_s",
+    "APD": "average_wave_period_s",
+    "MWD": "mean_wave_direction_deg",
+    "PRES": "atmospheric_pressure_hpa",
+    "ATMP": "air_temperature_c",
+    "WTMP": "water_temperature_c",
+    "DEWP": "dewpoint_temperature_c",
+    "VIS": "visibility_nmi",
+    "PTDY": "pressure_tendency_hpa",
+    "TIDE": "tide_m",
+}
+
+# Max requests per second, rate limited to be nice to the NOAA buoycam website
 MAX_REQUESTS_PER_SECOND = 10
 
+# Max number of requests in flight at once
+MAX_CONCURRENT_REQUESTS = 100
+
+# Seconds to keep resolved DNS entries for the NOAA hosts
+DNS_CACHE_TTL_SECONDS = 300
+
 REQUEST_TIMEOUT_SECONDS = 5
 
-# Number of worker threads
-NUM_WORKER_THREADS = 100
+T = TypeVar("T")
 
 LOGGER = logging.getLogger(__name__)
 
@@ -50,37 +101,33 @@ LOGGER = logging.getLogger(__name__)
 # pylint: disable=line-too-long
 
 
+@dataclass(slots=True)
 class BuoyPosition:
     """
     BuoyPosition is a class that encapsulates the position of a buoy in degrees latitude and longitude.
     """
 
-    def __init__(self, lat_deg, lon_deg):
-        self.lat_deg = lat_deg
-        self.lon_deg = lon_deg
+    lat_deg: float
+    lon_deg: float
 
     def __str__(self):
         return f"BuoyPosition(lat={self.lat_deg}, lon={self.lon_deg})"
 
 
+@dataclass(slots=True)
 class BuoyInfo:
     """
     BuoyInfo is a class that encapsulates the information for a buoy received from
     """
 
-    def __init__(
-        self,
-        identifier: str,
-        tag: str,
-        description: str,
-        position: BuoyPosition,
-        date: datetime.datetime,
-    ):
-        self.station_id = identifier
-        self.tag = tag
-        self.description = description
-        self.position = position
-        self.date = date
+    station_id: str
+    tag: str
+    description: str
+    position: BuoyPosition
+    date: datetime.datetime
+    # The formatted date is used for every path, url and observation look up of the request, so it is cached on first
+    # use. functools.cached_property needs an instance __dict__, which the slots remove
+    _date_string: Optional[str] = field(default=None, init=False, repr=False, compare=False)
 
     def __str__(self):
         return (
@@ -89,7 +136,9 @@ class BuoyInfo:
         )
 
     def date_string(self):
-        return self.date.strftime("%Y_%m_%d_%H%M")
+        if self._date_string is None:
+            self._date_string = self.date.strftime("%Y_%m_%d_%H%M")
+        return self._date_string
 
     def image_name(self):
         return f"{self.tag}_{self.date_string()}"
@@ -111,51 +160,139 @@ class BuoyInfo:
 
 class BuoyData:
     """
-    A collection of observations for a buoy.
-    """
+    A table of observations for a buoy.
 
-    def __init__(self, station_id: str):
-        self.station_id = station_id
-        # key is the date string, value is the observation
-        self.observations: Dict[str, Observation] = {}
+    The observations are stored with one float column per observation attribute, indexed by the observation date
+    string. Observation objects are only built for the observations that are used.
+    """
 
-    def add_observation(self, observation: Observation):
-        self.observations[observation.timestamp] = observation
+    def __init__(self, info: BuoyInfo, observations: pd.DataFrame):
+        self.station_id = info.station_id
+        self.info = info
+        self.observations = observations
 
     def has_observation(self, timestamp):
-        return timestamp in self.observations
+        return timestamp in self.observations.index
 
     def get_observation(self, timestamp):
-        if self.has_observation(timestamp):
-            return self.observations[timestamp]
-        return None
+        if not self.has_observation(timestamp):
+            return None
+        row = self.observations.loc[timestamp]
+        return Observation(
+            station_id=self.station_id,
+            timestamp=timestamp,
+            description=self.info.description,
+            lat_deg=self.info.position.lat_deg,
+            lon_deg=self.info.position.lon_deg,
+            **{attribute: None if pd.isna(value) else float(value) for attribute, value in row.items()},
+        )
 
 
-class OCR:
+class AngleCache:
     """
-    Extracts text from images using OCR
+    On disk cache of the angles read from angle crops, keyed by a hash of the recognizer and the crop pixels.
+
+    Most buoys are fixed in place, so the same bearing crop is seen across many images of a station. Angles that
+    could not be read are cached as None.
     """
 
-    def __init__(self):
-        self.reader = easyocr.Reader(["en"])
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # The cache is used from the executor threads, one batch of crops at a time
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS angles (hash TEXT PRIMARY KEY, angle INTEGER)")
+        self.connection.commit()
+
+    @staticmethod
+    def key(grey_crop: np.ndarray, recognizer_id: str) -> str:
+        # The recognizer is part of the key so angles read by a different model are not served from the cache
+        hasher = hashlib.blake2b(recognizer_id.encode("utf-8"), digest_size=16)
+        hasher.update(grey_crop.tobytes())
+        return hasher.hexdigest()
+
+    def get(self, keys: List[str]) -> Dict[str, int]:
+        # Return the cached angle of each key that is in the cache
+        found = {}
+        for start in range(0, len(keys), ANGLE_CACHE_QUERY_SIZE):
+            query_keys = keys[start : start + ANGLE_CACHE_QUERY_SIZE]
+            rows = self.connection.execute(
+                f"SELECT hash, angle FROM angles WHERE hash IN ({','.join('?' * len(query_keys))})", query_keys
+            )
+            found.update(rows.fetchall())
+        return found
 
-    def get_all_text_from_image(self, image):
-        # Get all text from the image
-        results = self.reader.readtext(np.array(image))
-        if len(results) == 0:
-            return None
+    def put(self, angles: Dict[str, int]):
+        self.connection.executemany("INSERT OR REPLACE INTO angles (hash, angle) VALUES (?, ?)", angles.items())
+        self.connection.commit()
 
-        # Concatenate all the text results
-        text_result = ""
-        for result in results:
-            text_result += result[1]
 
-        return text_result
+class OCR:
+    """
+    Extracts the bearing text from the angle crops using OCR.
 
-    def get_angle_from_image(self, image):
-        # Get angle in degrees from the image
-        results = self.reader.readtext(np.array(image))
+    The bearing is always drawn at the same position in the image, so the text detector is skipped and the recognizer
+    is run directly on the whole crop. If an exported recognizer model is given it is run with ONNX Runtime in place
+    of the torch recognizer. Identical crops are only read once, and with a cache path the results are kept across
+    runs.
+    """
 
+    def __init__(self, batch_size: int = OCR_BATCH_SIZE, recognizer_model_path: str = None, cache_path: str = None):
+        self.batch_size = batch_size
+        self.cache = AngleCache(cache_path) if cache_path is not None else None
+        self.reader = easyocr.Reader(["en"], detector=False, cudnn_benchmark=True)
+        if recognizer_model_path is not None:
+            self.reader.recognizer = OnnxRecognizer(recognizer_model_path)
+        self.recognizer_id = self.recognizer_identity(recognizer_model_path)
+        # Characters the recognizer knows that are not in the reader's languages are ignored, as easyocr does
+        self.ignore_char = "".join(set(self.reader.character) - set(self.reader.lang_char))
+        # Run a warmup batch so the cuDNN autotuning cost is not paid on the first real batch
+        if self.reader.device != "cpu":
+            self.recognize([np.zeros([ANGLE_CROP_HEIGHT, ANGLE_CROP_WIDTH], dtype=np.uint8)] * batch_size)
+
+    def recognize(self, grey_crops: List[np.ndarray]) -> List[list]:
+        # Stack the crops vertically and cut them back out as one box each. The recognizer is called directly rather
+        # than through Reader.recognize, which reads the boxes one at a time on the cpu
+        stacked = np.concatenate(grey_crops, axis=0)
+        boxes = [
+            [0, ANGLE_CROP_WIDTH, i * ANGLE_CROP_HEIGHT, (i + 1) * ANGLE_CROP_HEIGHT] for i in range(len(grey_crops))
+        ]
+        image_list, max_width = get_image_list(boxes, [], stacked, model_height=RECOGNIZER_IMAGE_HEIGHT)
+        results = get_text(
+            self.reader.character,
+            RECOGNIZER_IMAGE_HEIGHT,
+            int(max_width),
+            self.reader.recognizer,
+            self.reader.converter,
+            image_list,
+            ignore_char=self.ignore_char,
+            batch_size=self.batch_size,
+            workers=0,
+            device=self.reader.device,
+        )
+
+        # Match the results back to their crop using the top of the result box
+        crop_results = [[] for _ in grey_crops]
+        for result in results:
+            crop_results[result[0][0][1] // ANGLE_CROP_HEIGHT].append(result)
+        return crop_results
+
+    @staticmethod
+    def recognizer_identity(recognizer_model_path: str = None) -> str:
+        # Identify the recognizer by the contents of its model file, or as the easyocr torch model
+        if recognizer_model_path is None:
+            return f"easyocr-{easyocr.__version__}"
+        hasher = hashlib.blake2b()
+        with open(recognizer_model_path, "rb") as file:
+            for chunk in iter(lambda: file.read(MODEL_HASH_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    @staticmethod
+    def parse_angle(results):
+        # Get angle in degrees from the recognizer results of a crop
         if len(results) == 0:
             return None
 
@@ -177,6 +314,30 @@ class OCR:
 
         return angle
 
+    def get_angles_from_images(self, images: List[Image.Image]) -> List[int]:
+        # Get the angle in degrees from each angle crop. The crops are recognized as fixed size boxes of one stacked
+        # image, so they must all be the size get_angle_crop cuts
+        for image in images:
+            if image.size != (ANGLE_CROP_WIDTH, ANGLE_CROP_HEIGHT):
+                raise ValueError(f"Angle crops must be {ANGLE_CROP_WIDTH}x{ANGLE_CROP_HEIGHT}, got {image.size}")
+        grey_crops = [np.asarray(image.convert("L")) for image in images]
+        keys = [AngleCache.key(grey_crop, self.recognizer_id) for grey_crop in grey_crops]
+        angles = self.cache.get(keys) if self.cache is not None else {}
+
+        # Run each distinct crop that is not cached through the recognizer in batches
+        to_read = {key: grey_crop for key, grey_crop in zip(keys, grey_crops) if key not in angles}
+        LOGGER.debug("Reading %d of %d angle crops, the rest are cached or duplicates", len(to_read), len(images))
+        read_keys = list(to_read)
+        for start in range(0, len(read_keys), self.batch_size):
+            batch_keys = read_keys[start : start + self.batch_size]
+            results = self.recognize([to_read[key] for key in batch_keys])
+            angles.update({key: self.parse_angle(result) for key, result in zip(batch_keys, results)})
+
+        if self.cache is not None and len(to_read) > 0:
+            self.cache.put({key: angles[key] for key in to_read})
+
+        return [angles[key] for key in keys]
+
 
 def get_latest_buoy_info() -> List[BuoyInfo]:
     buoy_json = utils.fetch_json(BUOYCAM_LIST_URL, REQUEST_TIMEOUT_SECONDS)
@@ -215,137 +376,122 @@ def get_latest_buoy_info() -> List[BuoyInfo]:
     return buoy_info_list
 
 
-def split_image(full_image: Image):
-    sub_images = []
-    for i in range(BUOYCAM_IMAGE_ROW_LENGTH):
-        left = i * SUB_IMAGE_WIDTH
-        sub_images.append(full_image.crop((left, 0, left + SUB_IMAGE_WIDTH, SUB_IMAGE_HEIGHT)))
-    return sub_images
+def sub_image_box(index: int) -> tuple:
+    left = index * SUB_IMAGE_WIDTH
+    return (left, 0, left + SUB_IMAGE_WIDTH, SUB_IMAGE_HEIGHT)
 
 
-def extract_table_data(url: str) -> list:
-    try:
-        response = requests.get(url, timeout=REQUEST_TIMEOUT_SECONDS)
-    except requests.exceptions.RequestException as e:
-        LOGGER.debug("Failed to get table data from %s due to %s", url, e)
-        return None
+def sub_image_fraction_black(full_image: Image) -> np.ndarray:
+    # Convert the full image to grayscale once and count the black pixels of every sub image in a single pass
+    gray = np.asarray(full_image.convert("L"))
+    return tile_black_fractions(gray, BUOYCAM_IMAGE_ROW_LENGTH, SUB_IMAGE_WIDTH, SUB_IMAGE_HEIGHT)
 
-    # verify that the request was successful
-    if response.status_code != 200:
-        LOGGER.debug(
-            "Failed to get table data from %s due to status code %s",
-            url,
-            response.status_code,
-        )
-        return None
 
-    data = response.text
-    lines = data.split("\n")
+async def fetch_bytes(session: aiohttp.ClientSession, limiter: AsyncLimiter, url: str) -> bytes:
+    # Wait for the rate limiter to be nice to the NOAA website
+    async with limiter:
+        try:
+            async with session.get(url) as response:
+                # verify that the request was successful
+                if response.status != 200:
+                    LOGGER.debug("Failed to get %s, code: %d, reason: %s", url, response.status, response.reason)
+                    return None
+                return await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            LOGGER.debug("Failed to get %s due to %s", url, e)
+            return None
+
+
+def parse_table_data(data: str) -> pd.DataFrame:
+    lines = data.split("\n", 2)
 
     # Verify that the file has at least 3 lines (header, units, and data)
     if len(lines) < 3:
         raise ValueError("File does not have enough lines")
 
-    # Extract the header and the first row.
-    # Skip the first character in the first row as it is just to denote it's a non data row
-    header = lines[0][1:].split()
-    # Skip the second line which is the units
-    rows = lines[2:]
-
-    result = []
-    for row in rows:
-        values = row.split()
-        if len(values) == 0:
-            continue
-        entry = {}
-        for i, h in enumerate(header):
-            entry[h] = values[i]
-        result.append(entry)
-
-    return result
+    # Skip the first character in the header as it is just to denote it's a non data row, and skip the second line
+    # which is the units. The timestamp columns are kept as strings to keep their zero padding, the rest are parsed
+    # as numbers with the missing data indicator as NaN.
+    return pd.read_csv(
+        StringIO(data[1:]),
+        sep=r"\s+",
+        skiprows=[1],
+        na_values=[MISSING_DATA_INDICATOR],
+        keep_default_na=False,
+        dtype={column: str for column in TIMESTAMP_TABLE_COLUMNS},
+    )
 
 
-def get_float(row: dict, key: str) -> float:
-    if key not in row:
-        return None
-    if row[key] == MISSING_DATA_INDICATOR:
+async def extract_table_data(session: aiohttp.ClientSession, limiter: AsyncLimiter, url: str) -> pd.DataFrame:
+    content = await fetch_bytes(session, limiter, url)
+    if content is None:
+        LOGGER.debug("Failed to get table data from %s", url)
         return None
 
-    return float(row[key])
+    return parse_table_data(content.decode("utf-8", errors="replace"))
 
 
-def table_row_to_observation(row, info: BuoyInfo) -> Observation:
+def table_to_observations(table: pd.DataFrame) -> pd.DataFrame:
     # Must have a timestamp
-    if "YY" not in row or "MM" not in row or "DD" not in row or "hh" not in row or "mm" not in row:
+    if not all(column in table for column in TIMESTAMP_TABLE_COLUMNS):
         return None
-    return Observation(
-        station_id=info.station_id,
-        timestamp=f'{row["YY"]}_{row["MM"]}_{row["DD"]}_{row["hh"]}{row["mm"]}',
-        description=info.description,
-        lat_deg=info.position.lat_deg,
-        lon_deg=info.position.lon_deg,
-        wind_speed_mps=get_float(row, "WSPD"),
-        wind_direction_deg=get_float(row, "WDIR"),
-        gust_speed_mps=get_float(row, "GST"),
-        wave_height_m=get_float(row, "WVHT"),
-        dominant_wave_period_s=get_float(row, "DPD"),
-        average_wave_period_s=get_float(row, "APD"),
-        mean_wave_direction_deg=get_float(row, "MWD"),
-        atmospheric_pressure_hpa=get_float(row, "PRES"),
-        air_temperature_c=get_float(row, "ATMP"),
-        water_temperature_c=get_float(row, "WTMP"),
-        dewpoint_temperature_c=get_float(row, "DEWP"),
-        visibility_nmi=get_float(row, "VIS"),
-        pressure_tendency_hpa=get_float(row, "PTDY"),
-        tide_m=get_float(row, "TIDE"),
-    )
 
+    columns = [column for column in OBSERVATION_TABLE_COLUMNS if column in table]
+    observations = (
+        table[columns]
+        .astype(np.float64)
+        .rename(columns=OBSERVATION_TABLE_COLUMNS)
+        .reindex(columns=list(OBSERVATION_TABLE_COLUMNS.values()))
+    )
 
-def get_observation_data(buoy_info: BuoyInfo) -> BuoyData:
+    observations.index = pd.Index(
+        table["YY"] + "_" + table["MM"] + "_" + table["DD"] + "_" + table["hh"] + table["mm"], name="timestamp"
+    )
+    # Keep the latest row of a repeated timestamp
+    return observations[~observations.index.duplicated(keep="last")]
 
-    with request_rate_limit_lock:
-        # Simple rate limiting mechanism to be nice to the NOAA website
-        time.sleep(1 / MAX_REQUESTS_PER_SECOND)
 
-    observation_data = extract_table_data(buoy_info.observation_url())
+async def get_observation_data(session: aiohttp.ClientSession, limiter: AsyncLimiter, buoy_info: BuoyInfo) -> BuoyData:
+    observation_data = await extract_table_data(session, limiter, buoy_info.observation_url())
     if observation_data is None:
         LOGGER.warning("Failed to get buoy data for buoy %s", buoy_info.station_id)
         return None
-    data = BuoyData(buoy_info.station_id)
-    for row in observation_data:
-        observation = table_row_to_observation(row, buoy_info)
-        if observation is not None:
-            data.add_observation(observation)
-        else:
-            LOGGER.warning("Failed to parse observation data for buoy %s", buoy_info.station_id)
-    return data
+    observations = table_to_observations(observation_data)
+    if observations is None:
+        LOGGER.warning("Failed to parse observation data for buoy %s", buoy_info.station_id)
+        return None
+    return BuoyData(buoy_info, observations)
 
 
-def get_angle_from_image(img: Image, ocr_reader: OCR):
+def get_angle_crop(img: Image) -> Image:
     assert img.width == IMAGE_WIDTH and img.height == IMAGE_HEIGHT
-    angle_crop = img.crop((150, img.height - 30, 250, img.height))
-    # Extract the angle from the image
-    return ocr_reader.get_angle_from_image(angle_crop)
-
+    return img.crop((ANGLE_CROP_LEFT, img.height - ANGLE_CROP_HEIGHT, ANGLE_CROP_LEFT + ANGLE_CROP_WIDTH, img.height))
 
-def fetch_image(request: BuoyInfo) -> Image:
 
-    # Simple rate limiting mechanism to be nice to the NOAA buoycam website
-    with request_rate_limit_lock:
-        time.sleep(1 / MAX_REQUESTS_PER_SECOND)
+async def fetch_image(
+    session: aiohttp.ClientSession, limiter: AsyncLimiter, request: BuoyInfo
+) -> Tuple[bytes, Image.Image]:
 
     # Get the image file
-    img = utils.fetch_image(request.image_url())
-    if img is None:
+    content = await fetch_bytes(session, limiter, request.image_url())
+    if content is None:
         LOGGER.debug("\t%s failed", request)
         return None
 
+    # Only the header is read here, the pixel data is decoded when the image is processed
+    try:
+        img = Image.open(BytesIO(content))
+    except OSError as e:
+        LOGGER.warning("\t%s: failed to open image due to %s", request, e)
+        return None
+
     # Verify the image size
     if img.width != IMAGE_WIDTH or img.height != IMAGE_HEIGHT:
-        LOGGER.warning("\t%d: image has invalid dimensions %dx%d", request, img.width, img.height)
+        LOGGER.warning("\t%s: image has invalid dimensions %dx%d", request, img.width, img.height)
         return None
 
-    return img
+    # Keep the encoded bytes so the full image can be saved without re-encoding it
+    return content, img
 
 
 def change_date(info: BuoyInfo, new_date: datetime.datetime) -> BuoyInfo:
@@ -353,35 +499,31 @@ def change_date(info: BuoyInfo, new_date: datetime.datetime) -> BuoyInfo:
 
 
 def extend_to_past(latest_list: List[BuoyInfo], hours_in_past: int, minute_list: List[int]) -> list[BuoyInfo]:
-    minute_list = sorted(minute_list, reverse=True)
-    extended_list = []
-    for latest in latest_list:
-        # Always add the latest image since we know it exists
-        extended_list.append(latest)
+    # Always add the latest image since we know it exists
+    if hours_in_past < 1 or len(latest_list) == 0:
+        return list(latest_list)
 
-        if hours_in_past < 1:
-            continue
+    latest_dates = pd.DatetimeIndex([latest.date for latest in latest_list]).to_numpy()
 
-        # For the first hour, add the minutes in the minute list if they are before the latest image
-        for minute in minute_list:
-            if minute < latest.date.minute:
-                extended_list.append(change_date(latest, latest.date.replace(minute=minute)))
+    # Build the grid of the minutes in the minute list for every hour from the hour of each latest image back to the
+    # hour hours_in_past before it, newest first, for all the buoys at once
+    hour_offsets = np.arange(hours_in_past + 1).astype("timedelta64[h]")
+    minute_offsets = np.array(sorted(minute_list, reverse=True), dtype=np.int64).astype("timedelta64[m]")
+    hour_starts = latest_dates.astype("datetime64[h]")
+    grid = hour_starts[:, None, None] - hour_offsets[None, :, None] + minute_offsets[None, None, :]
+    grid = grid.reshape(len(latest_list), -1)
 
-        # For the rest of the hours, add all the minutes in the minute list
-        for i in range(1, hours_in_past):
-            # Get the start of the hour by subtracting i hours and zeroing out everything less than an hour
-            hour_start = (latest.date - datetime.timedelta(hours=i)).replace(minute=0, second=0, microsecond=0)
+    # Keep the dates before the latest image and no more than hours_in_past before it
+    latest_column = latest_dates[:, None]
+    in_range = (grid < latest_column) & (grid >= latest_column - np.timedelta64(hours_in_past, "h"))
 
-            for minute in minute_list:
-                extended_list.append(change_date(latest, hour_start.replace(minute=minute)))
+    past_dates = pd.DatetimeIndex(grid[in_range]).to_pydatetime()
+    past_counts = np.cumsum(in_range.sum(axis=1))
 
-        # For the last hour, add all the minutes in the minute list that are after the latest image minute
-        last_hour_start = (latest.date - datetime.timedelta(hours=hours_in_past)).replace(
-            minute=0, second=0, microsecond=0
-        )
-        for minute in minute_list:
-            if minute >= latest.date.minute:
-                extended_list.append(change_date(latest, last_hour_start.replace(minute=minute)))
+    extended_list = []
+    for latest, start, stop in zip(latest_list, np.concatenate(([0], past_counts[:-1])), past_counts):
+        extended_list.append(latest)
+        extended_list.extend(change_date(latest, date) for date in past_dates[start:stop])
 
     return extended_list
 
@@ -403,20 +545,20 @@ def save_observation_data(observation: Observation, info: BuoyInfo, output_dir:
     )
 
 
-def save_image(img: Image, info: BuoyInfo, output_dir: str):
+def save_image(content: bytes, img: Image, info: BuoyInfo, output_dir: str):
     # make the folder if it doesn't exist
     if not os.path.exists(info.save_directory(output_dir)):
         os.makedirs(info.save_directory(output_dir))
 
-    # Save the full image
+    # Save the full image, writing the original bytes through rather than re-encoding the decoded image
     full_image_path = info.image_full_path(output_dir, "full")
-    img.save(full_image_path)
+    with open(full_image_path, "wb") as file:
+        file.write(content)
     LOGGER.debug("\tFull image saved at %s", full_image_path)
 
     # Save the sub images
-    for i, sub_img in enumerate(split_image(img)):
+    for i, fraction_black_value in enumerate(sub_image_fraction_black(img)):
         # Check if the sub image is mostly black
-        fraction_black_value = utils.fraction_black(sub_img)
         if fraction_black_value > FRACTION_BLACK_THRESHOLD:
             LOGGER.debug(
                 "\t\tSub image %s is %.2f%% black, skipping",
@@ -427,22 +569,46 @@ def save_image(img: Image, info: BuoyInfo, output_dir: str):
         LOGGER.debug("\t\tSub image %i is %.2f%% black", i, fraction_black_value * 100)
 
         sub_img_path = info.image_full_path(output_dir, str(i))
-        sub_img.save(sub_img_path)
+        img.crop(sub_image_box(i)).save(sub_img_path)
         LOGGER.debug("\t\tSub image %d saved at %s", i, sub_img_path)
 
 
-def image_pipeline(info: BuoyInfo, observation: Observation, output_dir: str, ocr_reader: OCR = None) -> bool:
+def process_image(content: bytes, image: Image, info: BuoyInfo, output_dir: str) -> Image:
+    save_image(content, image, info, output_dir)
+    return get_angle_crop(image)
 
-    image = fetch_image(info)
-    if image is None:
-        return False
 
-    if ocr_reader is not None:
-        observation.bearing_of_first_image_deg = get_angle_from_image(image, ocr_reader)
+async def image_pipeline(
+    session: aiohttp.ClientSession, limiter: AsyncLimiter, executor: Executor, info: BuoyInfo, output_dir: str
+) -> Image:
+    # Returns the crop containing the bearing of the first sub image so the OCR can be batched after all fetches
 
-    save_image(image, info, output_dir)
-    save_observation_data(observation, info, output_dir)
-    return True
+    fetched = await fetch_image(session, limiter, info)
+    if fetched is None:
+        return None
+    content, image = fetched
+
+    # Decode and save the image off of the event loop
+    return await asyncio.get_running_loop().run_in_executor(executor, process_image, content, image, info, output_dir)
+
+
+def save_observations(
+    ocr_reader: OCR, fetched_requests: List[Tuple[BuoyInfo, BuoyData]], angle_crops: List[Image.Image], output_dir: str
+):
+    # Extract the bearing of the first sub image from a batch of fetched images at once
+    LOGGER.info("Extracting bearings from %d images", len(angle_crops))
+    bearings = ocr_reader.get_angles_from_images(angle_crops)
+
+    # Save the observation data for each fetched image
+    for (request, buoy_data), bearing in zip(fetched_requests, bearings):
+        obs = buoy_data.get_observation(request.date_string())
+        obs.bearing_of_first_image_deg = bearing
+        save_observation_data(obs, request, output_dir)
+
+
+async def tag_result(tag: T, awaitable: Awaitable) -> Tuple[T, object]:
+    # Pair the result of an awaitable with a tag so results can be matched with their inputs as they complete
+    return tag, await awaitable
 
 
 def already_fetched(info: BuoyInfo, output_dir: str) -> bool:
@@ -460,7 +626,7 @@ def already_fetched(info: BuoyInfo, output_dir: str) -> bool:
     return True
 
 
-def main(args):
+async def main(args):
 
     LOGGER.info(
         "Starting buoycam fetcher, getting images for the last %d hours. %s",
@@ -476,16 +642,23 @@ def main(args):
 
     LOGGER.info("Found %d buoycams", len(latest_info_list))
 
-    # Observation look up object
-    buoy_data_lookup: Dict[str, BuoyData] = {}
-
-    # Get observation data for all buoycams
-    with ThreadPoolExecutor(max_workers=NUM_WORKER_THREADS) as executor:
-        futures_to_input = {executor.submit(get_observation_data, info): info for info in latest_info_list}
-
-        for future in as_completed(futures_to_input):
-            result = future.result()
-            buoy = futures_to_input[future]
+    # A single session shares the connection pool across all requests, the connector limit bounds the requests in
+    # flight while the limiter bounds the request rate
+    limiter = AsyncLimiter(MAX_REQUESTS_PER_SECOND, 1)
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_REQUESTS, ttl_dns_cache=DNS_CACHE_TTL_SECONDS)
+    # Like the requests timeout, bound each connect and socket read rather than the whole request, so a slow but
+    # progressing download is not cut off
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=REQUEST_TIMEOUT_SECONDS, sock_read=REQUEST_TIMEOUT_SECONDS)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        # Observation look up object
+        buoy_data_lookup: Dict[str, BuoyData] = {}
+
+        # Get observation data for all buoycams
+        for coroutine in asyncio.as_completed(
+            [tag_result(info, get_observation_data(session, limiter, info)) for info in latest_info_list]
+        ):
+            buoy, result = await coroutine
             LOGGER.info(
                 "Completed observation request for %s, success: %s",
                 buoy.station_id,
@@ -494,55 +667,78 @@ def main(args):
             if result is not None:
                 buoy_data_lookup[result.station_id] = result
 
-    LOGGER.info("Retrieved observation data for %s buoycams", len(buoy_data_lookup))
-
-    # OCR reader
-    ocr_reader = OCR()
-
-    # Generate image requests for all buoycams that have observation data
-    if args.hours_in_past < 1:
-        LOGGER.info("Only fetching the latest images")
-        image_requests = latest_info_list
-    else:
-        image_requests = extend_to_past([info for info in latest_info_list], args.hours_in_past, args.minute_list)
-
-    # Only request images that we have observation data for and that we haven't already fetched
-    filtered_requests = []
-    for ir in image_requests:
-        if ir.station_id not in buoy_data_lookup:
-            LOGGER.warning("Buoy %s does not have observation data", ir.station_id)
-            continue
-        if not buoy_data_lookup[ir.station_id].has_observation(ir.date_string()):
-            LOGGER.warning("Buoy %s does not have observation data for %s", ir.station_id, ir.date_string())
-            continue
-
-        if already_fetched(ir, args.output):
-            LOGGER.debug("Buoy %s at %s already fetched", ir.station_id, ir.date_string())
-            continue
-
-        filtered_requests.append(ir)
+        LOGGER.info("Retrieved observation data for %s buoycams", len(buoy_data_lookup))
 
-    LOGGER.info("Generated %s image requests", len(filtered_requests))
+        # OCR reader
+        ocr_reader = OCR(recognizer_model_path=args.ocr_model, cache_path=args.ocr_cache)
 
-    # store the results [pass, fail] of the image requests according to the minute
-    minute_result_map: Dict[int, List[int]] = {}
+        # Generate image requests for all buoycams that have observation data
+        if args.hours_in_past < 1:
+            LOGGER.info("Only fetching the latest images")
+            image_requests = latest_info_list
+        else:
+            image_requests = extend_to_past([info for info in latest_info_list], args.hours_in_past, args.minute_list)
 
-    # Fetch, process and save the images
-    with ThreadPoolExecutor(max_workers=NUM_WORKER_THREADS) as executor:
+        # Only request images that we have observation data for, keeping the buoy data of each request alongside it
+        observed_requests: List[Tuple[BuoyInfo, BuoyData]] = []
+        for ir in image_requests:
+            buoy_data = buoy_data_lookup.get(ir.station_id)
+            if buoy_data is None or not buoy_data.has_observation(ir.date_string()):
+                continue
+            observed_requests.append((ir, buoy_data))
 
-        futures_to_request = {}
-        for request in filtered_requests:
-            obs = buoy_data_lookup[request.station_id].get_observation(request.date_string())
-            future = executor.submit(image_pipeline, request, obs, args.output, ocr_reader)
-            futures_to_request[future] = request
+        if len(observed_requests) < len(image_requests):
+            LOGGER.warning(
+                "%d of %d image requests do not have observation data",
+                len(image_requests) - len(observed_requests),
+                len(image_requests),
+            )
 
-        for future in as_completed(futures_to_request):
-            result = future.result()
-            request = futures_to_request[future]
-            LOGGER.info("Completed %s, success: %s", request, result)
-            if minute_result_map.get(request.date.minute) is None:
-                minute_result_map[request.date.minute] = [0, 0]
-            minute_result_map[request.date.minute][int(result)] += 1
+        # and that we haven't already fetched
+        filtered_requests = [(ir, bd) for ir, bd in observed_requests if not already_fetched(ir, args.output)]
+        LOGGER.debug("%d image requests already fetched", len(observed_requests) - len(filtered_requests))
+
+        LOGGER.info("Generated %s image requests", len(filtered_requests))
+
+        # store the results [pass, fail] of the image requests according to the minute
+        minute_result_map: Dict[int, List[int]] = {}
+
+        # Fetched requests with their buoy data and their angle crops, index aligned, that are waiting for OCR
+        fetched_requests: List[Tuple[BuoyInfo, BuoyData]] = []
+        angle_crops: List[Image.Image] = []
+
+        # Fetch the images on the event loop, decoding and saving them in the worker threads
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor() as executor:
+            for coroutine in asyncio.as_completed(
+                [
+                    tag_result((request, buoy_data), image_pipeline(session, limiter, executor, request, args.output))
+                    for request, buoy_data in filtered_requests
+                ]
+            ):
+                (request, buoy_data), angle_crop = await coroutine
+                result = angle_crop is not None
+                LOGGER.info("Completed %s, success: %s", request, result)
+                if minute_result_map.get(request.date.minute) is None:
+                    minute_result_map[request.date.minute] = [0, 0]
+                minute_result_map[request.date.minute][int(result)] += 1
+
+                if result:
+                    fetched_requests.append((request, buoy_data))
+                    angle_crops.append(angle_crop)
+
+                # Read the bearings and save the observations a batch at a time, so the saved images get their
+                # observations as the fetch goes rather than all at the end
+                if len(angle_crops) >= ocr_reader.batch_size:
+                    await loop.run_in_executor(
+                        executor, save_observations, ocr_reader, fetched_requests, angle_crops, args.output
+                    )
+                    fetched_requests, angle_crops = [], []
+
+            if len(angle_crops) > 0:
+                await loop.run_in_executor(
+                    executor, save_observations, ocr_reader, fetched_requests, angle_crops, args.output
+                )
 
     LOGGER.info("Requests complete. Results by minute:")
     for minute, counts in minute_result_map.items():
@@ -581,6 +777,18 @@ if __name__ == "__main__":
         ),
         default=[0, 10, 20, 30, 40, 50],
     )
+    arg_parser.add_argument(
+        "--ocr-model",
+        type=str,
+        help="Path to an ONNX recognizer exported with seesea.onnx_ocr, by default the easyocr torch model is used",
+        default=None,
+    )
+    arg_parser.add_argument(
+        "--ocr-cache",
+        type=str,
+        help="Path to the cache of angles read from the images",
+        default=ANGLE_CACHE_PATH,
+    )
 
     input_args = arg_parser.parse_args()
 
@@ -597,6 +805,6 @@ if __name__ == "__main__":
         file_logging_handler.setFormatter(log_formatter)
         LOGGER.addHandler(file_logging_handler)
 
-    main(input_args)
+    asyncio.run(main(input_args))
 
     LOGGER.info("Total runtime %.2fs", time.time() - execution_start_time)
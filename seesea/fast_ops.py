@@ -0,0 +1,37 @@
+"""
+Compiled pixel operations for the image processing hot paths
+"""
+
+import numpy as np
+from numba import njit
+
+
+@njit(nogil=True, cache=True)
+def tile_black_fractions(gray: np.ndarray, num_tiles: int, tile_width: int, tile_height: int) -> np.ndarray:
+    """
+    Get the fraction of black pixels in each tile of a row of tiles along the top of a grayscale image
+
+    Compiled without the GIL so the image worker threads can run it in parallel.
+
+    Args:
+        gray: A 2D uint8 grayscale image at least tile_height high and num_tiles * tile_width wide
+        num_tiles: The number of tiles in the row
+        tile_width: The width of each tile
+        tile_height: The height of each tile
+
+    Returns:
+        The fraction of black pixels in each tile
+    """
+    fractions = np.zeros(num_tiles, dtype=np.float64)
+    for tile in range(num_tiles):
+        left = tile * tile_width
+        count = 0
+        for row in range(tile_height):
+            tile_row = gray[row, left : left + tile_width]
+            # A narrow per row counter summing the comparison, rather than branching on it, lets LLVM vectorize
+            row_count = np.int32(0)
+            for col in range(tile_width):
+                row_count += np.int32(tile_row[col] == 0)
+            count += row_count
+        fractions[tile] = count / (tile_width * tile_height)
+    return fractions
@@ -14,6 +14,10 @@ from seesea.observation import Observation, ImageObservation, to_webdataset, get
 
 LOGGER = logging.getLogger(__name__)
 
+# Images are decoded at 1/8 size for the brightness calculation. Each pixel is then the average of its 8x8 DCT block,
+# so the mean brightness matches the full size decode to within a fraction of a level.
+BRIGHTNESS_IMAGE_REDUCE = 8
+
 
 def filter_by_observation_keys(
     image_observations: List[ImageObservation], observation_keys: List[str]
@@ -32,7 +36,7 @@ def calculate_image_brightnesses(image_observations: List[ImageObservation]) ->
         # load image
         if i % 5000 == 0:
             LOGGER.debug("Read image %d", i)
-        img = utils.load_image(image_observation.image_path)
+        img = utils.load_image(image_observation.image_path, BRIGHTNESS_IMAGE_REDUCE)
         if img is None:
             LOGGER.warning("Failed to load image %s", image_observation.image_path)
             continue
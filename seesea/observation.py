@@ -8,7 +8,7 @@ from seesea import utils
 import webdataset as wds
 
 
-@dataclass
+@dataclass(slots=True)
 class Observation:
     """
     Observation data for a buoy at a specific time.
@@ -0,0 +1,181 @@
+"""
+Export the easyocr text recognizer to ONNX and run it with ONNX Runtime
+"""
+
+import os
+import logging
+from typing import List
+
+import easyocr
+import onnxruntime as ort
+from onnxruntime.quantization import QuantType, quantize_dynamic
+import torch
+import torch.nn as nn
+
+LOGGER = logging.getLogger(__name__)
+
+RECOGNIZER_INPUT_NAME = "image"
+RECOGNIZER_OUTPUT_NAME = "preds"
+
+# easyocr resizes all text crops to this height before recognition
+RECOGNIZER_IMAGE_HEIGHT = 64
+
+ONNX_OPSET_VERSION = 17
+
+# Operators to quantize to int8. The convolutions are left in float, ONNX Runtime's integer convolution is much slower
+# than its float convolution on the cpu
+QUANTIZED_OP_TYPES = ["MatMul", "Gemm", "LSTM"]
+
+# Directory OpenVINO caches its compiled models in, so they are only compiled on the first run
+OPENVINO_CACHE_DIR = os.path.join("cache", "openvino")
+
+
+class RecognizerExportWrapper(nn.Module):
+    """
+    Exportable forward pass of the easyocr recognizer.
+
+    The CTC recognizer ignores its text argument, so it is dropped and the exported graph only takes the image. The
+    adaptive pooling over the permuted features reduces the feature height to 1, it is replaced with the equivalent
+    mean as ONNX can not export adaptive pooling with a dynamic width.
+    """
+
+    def __init__(self, recognizer: nn.Module):
+        super().__init__()
+        self.recognizer = recognizer
+
+    def forward(self, image):
+        visual_feature = self.recognizer.FeatureExtraction(image)
+        visual_feature = visual_feature.permute(0, 3, 1, 2).mean(dim=3)
+        contextual_feature = self.recognizer.SequenceModeling(visual_feature)
+        return self.recognizer.Prediction(contextual_feature.contiguous())
+
+
+def export_recognizer(output_path: str, lang_list: List[str] = None):
+    """
+    Export the easyocr recognizer to an ONNX model
+
+    Args:
+        output_path: The path to write the ONNX model to
+        lang_list: The easyocr languages of the recognizer to export, defaults to english
+    """
+    # Load the float model on the cpu, the quantized torch model can not be exported
+    reader = easyocr.Reader(lang_list or ["en"], gpu=False, detector=False, quantize=False)
+    model = RecognizerExportWrapper(reader.recognizer).eval()
+
+    output_dir = os.path.dirname(output_path)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    # The batch size and the width of the crops vary between calls
+    dummy_input = torch.zeros(1, 1, RECOGNIZER_IMAGE_HEIGHT, 256)
+    torch.onnx.export(
+        model,
+        (dummy_input,),
+        output_path,
+        input_names=[RECOGNIZER_INPUT_NAME],
+        output_names=[RECOGNIZER_OUTPUT_NAME],
+        dynamic_axes={
+            RECOGNIZER_INPUT_NAME: {0: "batch", 3: "width"},
+            RECOGNIZER_OUTPUT_NAME: {0: "batch", 1: "sequence"},
+        },
+        opset_version=ONNX_OPSET_VERSION,
+        dynamo=False,
+    )
+    LOGGER.info("Recognizer exported to %s", output_path)
+
+
+def quantize_recognizer(model_path: str, output_path: str):
+    """
+    Dynamically quantize the weights of an exported recognizer to int8
+
+    Args:
+        model_path: The path of the exported float recognizer
+        output_path: The path to write the quantized recognizer to
+    """
+    quantize_dynamic(
+        model_path,
+        output_path,
+        op_types_to_quantize=QUANTIZED_OP_TYPES,
+        per_channel=False,
+        weight_type=QuantType.QInt8,
+    )
+    LOGGER.info("Quantized recognizer saved to %s", output_path)
+
+
+def available_providers() -> list:
+    """
+    Get the ONNX Runtime execution providers to use, in order of preference
+
+    The OpenVINO provider is only available when the onnxruntime-openvino package is installed in place of
+    onnxruntime, it is preferred over the default cpu provider for its cpu tuned kernels.
+    """
+    preferred = {
+        "CUDAExecutionProvider": {},
+        "OpenVINOExecutionProvider": {"device_type": "CPU", "cache_dir": OPENVINO_CACHE_DIR},
+        "CPUExecutionProvider": {},
+    }
+    available = ort.get_available_providers()
+    return [(provider, options) for provider, options in preferred.items() if provider in available]
+
+
+class OnnxRecognizer:
+    """
+    Runs an exported recognizer with ONNX Runtime.
+
+    Stands in for the torch recognizer of an easyocr Reader, so easyocr's preprocessing and decoding are reused. A
+    single session is shared by all callers, ONNX Runtime sessions are thread safe.
+    """
+
+    def __init__(self, model_path: str, num_threads: int = 0):
+        if not os.path.exists(model_path):
+            raise ValueError(f"Recognizer model file {model_path} does not exist")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # 0 lets ONNX Runtime pick the number of threads
+        options.intra_op_num_threads = num_threads
+
+        self.session = ort.InferenceSession(model_path, options, providers=available_providers())
+        LOGGER.info("Loaded recognizer %s with providers %s", model_path, self.session.get_providers())
+
+    def eval(self):
+        # easyocr puts the recognizer into evaluation mode before each prediction
+        return self
+
+    def __call__(self, image: torch.Tensor, text: torch.Tensor = None) -> torch.Tensor:
+        preds = self.session.run([RECOGNIZER_OUTPUT_NAME], {RECOGNIZER_INPUT_NAME: image.cpu().numpy()})[0]
+        return torch.from_numpy(preds).to(image.device)
+
+
+def get_args_parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export the easyocr recognizer to ONNX")
+    parser.add_argument("--output", help="The path to write the ONNX model to", default="models/recognizer.onnx")
+    parser.add_argument(
+        "--quantize-output",
+        help="If set, also write an int8 dynamically quantized copy of the recognizer to this path",
+        default=None,
+    )
+    parser.add_argument("--log", type=str, help="Log level", default="INFO")
+    return parser
+
+
+if __name__ == "__main__":
+
+    parser = get_args_parser()
+
+    args = parser.parse_args()
+
+    # setup the loggers
+    LOGGER.setLevel(args.log)
+
+    log_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    console_logging_handler = logging.StreamHandler()
+    console_logging_handler.setFormatter(log_formatter)
+    LOGGER.addHandler(console_logging_handler)
+
+    export_recognizer(args.output)
+
+    if args.quantize_output is not None:
+        quantize_recognizer(args.output, args.quantize_output)
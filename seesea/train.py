@@ -4,6 +4,7 @@ import os
 import logging
 import datetime
 import json
+from contextlib import nullcontext
 from dataclasses import dataclass, asdict
 from typing import List, Callable
 from functools import partial
@@ -22,6 +23,9 @@ import seesea.utils as utils
 
 LOGGER = logging.getLogger(__name__)
 
+# Number of batches each data loader worker loads ahead
+PREFETCH_FACTOR = 4
+
 
 @dataclass
 class TrainingDetails:
@@ -40,8 +44,16 @@ class TrainingDetails:
         return asdict(self)
 
 
-def train_one_epoch(model, criterion, optimizer, loader, device, scheduler=None):
-    """Train the model for one epoch"""
+def autocast_context(device, amp_dtype=None):
+    """Autocast to the given dtype, or do nothing in full precision"""
+    # torch.autocast checks the device type even when disabled, and raises on devices it does not support
+    if amp_dtype is None:
+        return nullcontext()
+    return torch.autocast(device_type=device.type, dtype=amp_dtype)
+
+
+def train_one_epoch(model, criterion, optimizer, loader, device, scheduler=None, scaler=None, amp_dtype=None):
+    """Train the model for one epoch, in mixed precision if an autocast dtype is given"""
     model.train()
     running_loss = 0.0
     inputs_processed = 0
@@ -49,20 +61,26 @@ def train_one_epoch(model, criterion, optimizer, loader, device, scheduler=None)
     for inputs, label in tqdm(loader, leave=False, desc="Training", disable=LOGGER.level > logging.INFO):
         # pring the percentage of the dataset that has been processed
 
-        inputs = inputs.to(device)
-        label = label.to(device)
+        inputs = inputs.to(device, non_blocking=True)
+        label = label.to(device, non_blocking=True)
 
         # Zero the parameter gradients
         optimizer.zero_grad()
 
         # Forward pass
-        outputs = model(inputs)
-        outputs = outputs.view(-1)  # Flatten outputs to match wind_speeds shape
-        loss = criterion(outputs, label.view(-1))
+        with autocast_context(device, amp_dtype):
+            outputs = model(inputs)
+            outputs = outputs.view(-1)  # Flatten outputs to match wind_speeds shape
+            loss = criterion(outputs, label.view(-1))
 
-        # Backward pass and optimization
-        loss.backward()
-        optimizer.step()
+        # Backward pass and optimization, scaling the loss so small float16 gradients do not underflow
+        if scaler is not None:
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            loss.backward()
+            optimizer.step()
 
         if scheduler is not None:
             scheduler.step()
@@ -73,20 +91,21 @@ def train_one_epoch(model, criterion, optimizer, loader, device, scheduler=None)
     return running_loss / inputs_processed
 
 
-def evaluate_model(model, criterion, loader, device):
-    """Evaluate the model"""
+def evaluate_model(model, criterion, loader, device, amp_dtype=None):
+    """Evaluate the model, in mixed precision if an autocast dtype is given"""
     model.eval()
     running_loss = 0.0
     inputs_processed = 0
 
-    with torch.no_grad():
+    with torch.inference_mode():
         for inputs, label in tqdm(loader, leave=False, desc="Validation", disable=LOGGER.level > logging.INFO):
-            inputs = inputs.to(device)
-            label = label.to(device)
+            inputs = inputs.to(device, non_blocking=True)
+            label = label.to(device, non_blocking=True)
 
-            outputs = model(inputs)
-            outputs = outputs.view(-1)
-            loss = criterion(outputs, label.view(-1))
+            with autocast_context(device, amp_dtype):
+                outputs = model(inputs)
+                outputs = outputs.view(-1)
+                loss = criterion(outputs, label.view(-1))
 
             running_loss += loss.item() * inputs.size(0)
             inputs_processed += inputs.size(0)
@@ -94,6 +113,30 @@ def evaluate_model(model, criterion, loader, device):
     return running_loss / inputs_processed
 
 
+def warmup_model(model, criterion, loader, device, amp_dtype=None):
+    """Run one training and one evaluation batch through the model without training it"""
+    inputs, label = next(iter(loader))
+    inputs = inputs.to(device, non_blocking=True)
+    label = label.to(device, non_blocking=True)
+
+    # Keep the normalization statistics the training mode forward pass updates
+    buffers = [buffer.clone() for buffer in model.buffers()]
+
+    model.train()
+    with autocast_context(device, amp_dtype):
+        loss = criterion(model(inputs).view(-1), label.view(-1))
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+
+    model.eval()
+    with torch.inference_mode(), autocast_context(device, amp_dtype):
+        model(inputs)
+
+    with torch.no_grad():
+        for buffer, saved in zip(model.buffers(), buffers):
+            buffer.copy_(saved)
+
+
 def collate(samples):
     """Collate the samples into a batch"""
     images = [s["image"] for s in samples]
@@ -136,9 +179,6 @@ def main(args):
     )
     val_ds = load_dataset("webdataset", data_dir=args.input, split="validation", streaming=True).map(validation_map_fn)
 
-    train_loader = DataLoader(train_ds, collate_fn=collate, batch_size=args.batch_size)
-    val_loader = DataLoader(val_ds, collate_fn=collate, batch_size=args.batch_size)
-
     if torch.cuda.is_available():
         device = torch.device("cuda")
     elif torch.backends.mps.is_available():
@@ -146,8 +186,36 @@ def main(args):
     else:
         device = torch.device("cpu")
 
+    # Decode and transform the images in worker processes that are kept alive between epochs. Pinned memory lets the
+    # host to device copies run asynchronously with the forward pass.
+    loader_options = {"collate_fn": collate, "batch_size": args.batch_size, "pin_memory": device.type == "cuda"}
+    if args.num_workers > 0:
+        loader_options.update(
+            {"num_workers": args.num_workers, "persistent_workers": True, "prefetch_factor": PREFETCH_FACTOR}
+        )
+    LOGGER.debug("Using data loader options: %s", loader_options)
+
+    train_loader = DataLoader(train_ds, **loader_options)
+    val_loader = DataLoader(val_ds, **loader_options)
+
     model = model.to(device)
 
+    # Compile the model on cuda, fusing kernels and capturing them in CUDA graphs. The compiled module shares its
+    # weights with the original model, which is kept for saving the state dict without the compiled module's key
+    # prefix. MPS and CPU run the eager model.
+    compiled_model = model
+    if device.type == "cuda" and not args.no_compile:
+        compiled_model = torch.compile(model, mode="reduce-overhead", fullgraph=False)
+
+    # Mixed precision on cuda. bfloat16 has the range of float32 so it needs no loss scaling, float16 does.
+    amp_dtype = None
+    scaler = None
+    if device.type == "cuda" and not args.no_amp:
+        amp_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        if amp_dtype == torch.float16:
+            scaler = torch.amp.GradScaler("cuda")
+        LOGGER.info("Using mixed precision training with %s", amp_dtype)
+
     # Loss Function and Optimizer
     criterion = nn.MSELoss()
     optimizer = torch.optim.AdamW(model.parameters(), lr=args.learning_rate)
@@ -155,6 +223,15 @@ def main(args):
     # scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=6, gamma=0.1)
     # schuduler = OneCycleLR(optimizer, max_lr=args.learning_rate, epochs=args.epochs, steps_per_epoch=len(train_loader))
 
+    # Compile the training and evaluation graphs on a warmup batch, so the compilation is not timed as part of the
+    # first epoch
+    if compiled_model is not model:
+        compile_start_time = datetime.datetime.now(tz=datetime.timezone.utc)
+        warmup_model(compiled_model, criterion, train_loader, device, amp_dtype)
+        LOGGER.info(
+            "Compiled the model, time: %s", datetime.datetime.now(tz=datetime.timezone.utc) - compile_start_time
+        )
+
     training_start_time = datetime.datetime.now(tz=datetime.timezone.utc)
 
     train_losses = []
@@ -165,7 +242,9 @@ def main(args):
         LOGGER.debug("Starting epoch %d/%d", epoch + 1, args.epochs)
         # Training Phase
         epoch_start_time = datetime.datetime.now(tz=datetime.timezone.utc)
-        epoch_loss = train_one_epoch(model, criterion, optimizer, train_loader, device, None)
+        epoch_loss = train_one_epoch(
+            compiled_model, criterion, optimizer, train_loader, device, None, scaler, amp_dtype
+        )
         train_losses.append(epoch_loss)
         LOGGER.info(
             "Epoch %d/%d, Training Loss: %.4f, time: %s",
@@ -177,7 +256,7 @@ def main(args):
 
         # Validation Phase
         val_start_time = datetime.datetime.now(tz=datetime.timezone.utc)
-        val_epoch_loss = evaluate_model(model, criterion, val_loader, device)
+        val_epoch_loss = evaluate_model(compiled_model, criterion, val_loader, device, amp_dtype)
         val_losses.append(val_epoch_loss)
         LOGGER.info(
             "Epoch %d/%d, Validation Loss: %.4f, time: %s",
@@ -259,6 +338,16 @@ def get_args_parser():
     parser.add_argument(
         "--rotation", type=float, help="The random rotation angle to use for data augmentation", default=None
     )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        help="The number of data loader worker processes, 0 loads the data in the main process",
+        default=os.cpu_count() or 0,
+    )
+    parser.add_argument("--no-amp", action="store_true", help="Disable mixed precision training on cuda")
+    parser.add_argument(
+        "--no-compile", action="store_true", help="Disable compiling the model with torch.compile on cuda"
+    )
     return parser
 
 
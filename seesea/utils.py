@@ -6,10 +6,11 @@ import logging
 import os
 import re
 import json
-from io import BytesIO
 from typing import Type, Any, Tuple, Callable
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import numpy as np
 import cv2
 from PIL import Image
@@ -19,6 +20,14 @@ import torchvision.models as models
 
 LOGGER = logging.getLogger(__name__)
 
+# Retry failed connections and gateway errors with a short exponential backoff
+HTTP_RETRY = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+
+# Session shared by all requests so connections to a host are kept alive and reused
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(max_retries=HTTP_RETRY))
+_session.mount("http://", HTTPAdapter(max_retries=HTTP_RETRY))
+
 
 def mps_to_kts(mps: float) -> float:
     """Convert meters per second to knots"""
@@ -58,7 +67,7 @@ def attributes_exist(obj, keys):
 def fetch_json(url, timeout=None):
     """Get a json object from a url"""
     try:
-        response = requests.get(url, timeout=timeout)
+        response = _session.get(url, timeout=timeout)
     except requests.exceptions.RequestException as e:
         LOGGER.debug("Failed to get json from %s due to %s", url, e)
         return None
@@ -80,27 +89,25 @@ def load_json(file_path):
         return None
 
 
-def fetch_image(url, timeout=None) -> Image:
-    """Get an image file from a url"""
-    try:
-        response = requests.get(url, timeout=timeout)
-    except requests.exceptions.RequestException as e:
-        LOGGER.warning("Failed to get image file at %s due to %s", url, e)
-        return None
-    if response.status_code != 200:
-        LOGGER.debug("Failed to get image file at %s, code: %d, reason: %s", url, response.status_code, response.reason)
-        return None
-    LOGGER.debug("Image file retrieved from %s ", url)
-    return Image.open(BytesIO(response.content))
+def load_image(image_path: str, reduce: int = 1) -> Image:
+    """
+    Load an image from a file path
 
+    Args:
+        image_path: The path of the image file
+        reduce: Decode JPEG images at 1/2, 1/4 or 1/8 of their size. libjpeg scales during the inverse DCT, so the
+            full size image is never decoded
 
-def load_image(image_path: str) -> Image:
-    """Load an image from a file path"""
+    Returns:
+        The image or None if it could not be opened
+    """
     try:
         img = Image.open(image_path)
     except Exception as e:
         LOGGER.warning("\tError loading image %s: %s", image_path, e)
         return None
+    if reduce > 1:
+        img.draft("RGB", (img.width // reduce, img.height // reduce))
     return img
 
 
@@ -122,8 +129,8 @@ def get_all_files(directory, reegex_pattern: re.Pattern = None):
 
 def fraction_black(img: Image) -> float:
     """Get the fraction of black pixels in an image"""
-    img_array = np.array(img.convert("L")).flatten()
-    return np.count_nonzero(img_array == 0) / len(img_array)
+    # The histogram is computed in C over the pixel buffer, avoiding a numpy copy of the image
+    return img.convert("L").histogram()[0] / (img.width * img.height)
 
 
 def get_brightness(img: Image) -> float:
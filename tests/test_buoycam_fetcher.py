@@ -1,6 +1,31 @@
+import os
+import tempfile
 import unittest
 from datetime import datetime
-from seesea.buoycam_fetcher import extend_to_past, BuoyInfo, BuoyPosition
+from unittest import mock
+
+from easyocr.utils import CTCLabelConverter
+import numpy as np
+from PIL import Image
+import torch
+
+import seesea.utils as utils
+from seesea.buoycam_fetcher import (
+    AngleCache,
+    BuoyData,
+    extend_to_past,
+    parse_table_data,
+    table_to_observations,
+    sub_image_box,
+    sub_image_fraction_black,
+    BuoyInfo,
+    BuoyPosition,
+    OCR,
+    BUOYCAM_IMAGE_ROW_LENGTH,
+    IMAGE_WIDTH,
+    IMAGE_HEIGHT,
+    SUB_IMAGE_WIDTH,
+)
 
 
 class TestExtendToPast(unittest.TestCase):
@@ -184,5 +209,197 @@ class TestExtendToPast(unittest.TestCase):
             self.assertEqual(result[i].date, expected_date)
 
 
+class TestSubImageFractionBlack(unittest.TestCase):
+
+    def make_image(self):
+        # Each sub image gets a different share of white columns, the bottom strip is always white
+        img = Image.new("RGB", (IMAGE_WIDTH, IMAGE_HEIGHT), "white")
+        for i in range(BUOYCAM_IMAGE_ROW_LENGTH):
+            left, top, _, bottom = sub_image_box(i)
+            black_width = SUB_IMAGE_WIDTH * i // (BUOYCAM_IMAGE_ROW_LENGTH - 1)
+            if black_width > 0:
+                img.paste((0, 0, 0), (left, top, left + black_width, bottom))
+        return img
+
+    def test_fraction_black_per_sub_image(self):
+        result = sub_image_fraction_black(self.make_image())
+        self.assertEqual(len(result), BUOYCAM_IMAGE_ROW_LENGTH)
+        for i, value in enumerate(result):
+            self.assertAlmostEqual(value, i / (BUOYCAM_IMAGE_ROW_LENGTH - 1))
+
+    def test_matches_fraction_black_of_cropped_sub_images(self):
+        img = self.make_image()
+        result = sub_image_fraction_black(img)
+        for i in range(BUOYCAM_IMAGE_ROW_LENGTH):
+            self.assertAlmostEqual(result[i], utils.fraction_black(img.crop(sub_image_box(i))))
+
+
+class TestAngleCache(unittest.TestCase):
+
+    def test_put_and_get(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = AngleCache(os.path.join(directory, "cache", "angle_ocr.db"))
+            crops = [np.full((30, 100), value, dtype=np.uint8) for value in (0, 1, 2)]
+            keys = [AngleCache.key(crop, "recognizer") for crop in crops]
+            self.assertEqual(len(set(keys)), len(keys))
+
+            cache.put({keys[0]: 120, keys[1]: None})
+            self.assertEqual(cache.get(keys), {keys[0]: 120, keys[1]: None})
+            cache.connection.close()
+
+    def test_key_depends_on_pixels_and_recognizer(self):
+        crop = np.full((30, 100), 7, dtype=np.uint8)
+        self.assertEqual(AngleCache.key(crop, "recognizer"), AngleCache.key(crop.copy(), "recognizer"))
+        self.assertNotEqual(AngleCache.key(crop, "recognizer"), AngleCache.key(crop, "other recognizer"))
+
+
+class StubRecognizer:
+    """Stands in for the easyocr recognizer, reading every crop as 45 degrees and recording the batch sizes"""
+
+    characters = "0123456789°"
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def eval(self):
+        return self
+
+    def __call__(self, image, text=None):
+        self.batch_sizes.append(image.shape[0])
+        # One confident prediction per output step, the 4, 5 and degree characters followed by blanks
+        preds = torch.full((image.shape[0], image.shape[3] // 4, len(self.characters) + 1), -100.0)
+        preds[:, :, 0] = 100.0
+        for step, character in enumerate("45°"):
+            preds[:, step, 0] = -100.0
+            preds[:, step, self.characters.index(character) + 1] = 100.0
+        return preds
+
+
+class StubReader:
+    def __init__(self, *args, **kwargs):
+        self.character = StubRecognizer.characters
+        self.lang_char = StubRecognizer.characters
+        self.converter = CTCLabelConverter(self.character)
+        self.recognizer = StubRecognizer()
+        self.device = "cpu"
+
+
+class TestOCR(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch("easyocr.Reader", StubReader):
+            self.ocr = OCR(batch_size=4)
+        self.recognizer = self.ocr.reader.recognizer
+
+    def test_no_warmup_on_cpu(self):
+        self.assertEqual(self.recognizer.batch_sizes, [])
+
+    def test_recognize_batches_crops(self):
+        crops = [np.full((30, 100), value, dtype=np.uint8) for value in range(10)]
+        results = self.ocr.recognize(crops)
+
+        self.assertEqual(self.recognizer.batch_sizes, [4, 4, 2])
+        self.assertEqual(len(results), len(crops))
+        self.assertTrue(all(self.ocr.parse_angle(result) == 45 for result in results))
+
+    def test_get_angles_from_images_rejects_other_sizes(self):
+        with self.assertRaises(ValueError):
+            self.ocr.get_angles_from_images([Image.new("L", (100, 30)), Image.new("L", (200, 30))])
+        self.assertEqual(self.recognizer.batch_sizes, [])
+
+    def test_recognizer_identity(self):
+        with tempfile.TemporaryDirectory() as directory:
+            identities = []
+            for contents in (b"model", b"other model"):
+                model_path = os.path.join(directory, "recognizer.onnx")
+                with open(model_path, "wb") as file:
+                    file.write(contents)
+                identities.append(OCR.recognizer_identity(model_path))
+        identities.append(OCR.recognizer_identity())
+        self.assertEqual(len(set(identities)), 3)
+
+    def test_get_angles_from_images(self):
+        def fake_recognize(grey_crops):
+            # Read each crop as ten times its pixel value
+            read_values.append([int(grey_crop[0, 0]) for grey_crop in grey_crops])
+            return [[(None, f"{int(grey_crop[0, 0]) * 10}°", 1.0)] for grey_crop in grey_crops]
+
+        def crop_image(value):
+            return Image.fromarray(np.full((30, 100), value, dtype=np.uint8))
+
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch("easyocr.Reader", StubReader):
+                ocr = OCR(batch_size=2, cache_path=os.path.join(directory, "angle_ocr.db"))
+            ocr.cache.put({AngleCache.key(np.asarray(crop_image(7)), ocr.recognizer_id): 70})
+
+            read_values = []
+            with mock.patch.object(ocr, "recognize", side_effect=fake_recognize):
+                angles = ocr.get_angles_from_images([crop_image(value) for value in (1, 7, 1, 2, 3)])
+
+                # Duplicates and cached crops are not read again, the rest are read in batches
+                self.assertEqual(read_values, [[1, 2], [3]])
+                self.assertEqual(angles, [10, 70, 10, 20, 30])
+
+                # The new reads are cached
+                read_values = []
+                self.assertEqual(ocr.get_angles_from_images([crop_image(3), crop_image(1)]), [30, 10])
+                self.assertEqual(read_values, [])
+
+                # A different recognizer does not use the cached angles
+                ocr.recognizer_id = "other recognizer"
+                self.assertEqual(ocr.get_angles_from_images([crop_image(7)]), [70])
+                self.assertEqual(read_values, [[7]])
+            ocr.cache.connection.close()
+
+
+class TestObservationTable(unittest.TestCase):
+
+    table = (
+        "#YY  MM DD hh mm WDIR WSPD GST  WVHT   DPD   APD MWD   PRES  ATMP  WTMP  DEWP  VIS PTDY  TIDE\n"
+        "#yr  mo dy hr mn degT m/s  m/s     m   sec   sec degT   hPa  degC  degC  degC  nmi  hPa    ft\n"
+        "2024 09 18 19 40 160  5.1  6.0    MM    MM    MM  MM 1015.8  17.6  18.2  15.3   MM   MM    MM\n"
+        "2024 09 18 19 30 170  5.0  6.5   1.2     8   5.1 100 1015.9  17.6  18.2  15.4   MM -1.0    MM\n"
+    )
+
+    def test_parse_table_data(self):
+        table = parse_table_data(self.table)
+        self.assertEqual(len(table), 2)
+        # The timestamp columns keep their zero padding
+        self.assertEqual(list(table["MM"]), ["09", "09"])
+        self.assertEqual(table["WSPD"].iloc[0], 5.1)
+        self.assertTrue(np.isnan(table["WVHT"].iloc[0]))
+
+    def test_parse_table_data_too_short(self):
+        with self.assertRaises(ValueError):
+            parse_table_data("#YY  MM DD hh mm WDIR\n")
+
+    def test_table_to_observations(self):
+        observations = table_to_observations(parse_table_data(self.table))
+        self.assertEqual(list(observations.index), ["2024_09_18_1940", "2024_09_18_1930"])
+        self.assertEqual(observations.loc["2024_09_18_1930", "wave_height_m"], 1.2)
+        self.assertTrue(np.isnan(observations.loc["2024_09_18_1940", "wave_height_m"]))
+        self.assertTrue(observations["tide_m"].isna().all())
+
+    def test_table_without_timestamp(self):
+        self.assertIsNone(table_to_observations(parse_table_data("#WSPD\n#m/s\n5.1\n")))
+
+    def test_get_observation(self):
+        info = BuoyInfo("41001", "W1", "description", BuoyPosition(1.0, 2.0), datetime(2024, 9, 18, 19, 40))
+        data = BuoyData(info, table_to_observations(parse_table_data(self.table)))
+
+        self.assertTrue(data.has_observation("2024_09_18_1940"))
+        self.assertFalse(data.has_observation("2024_09_18_1950"))
+        self.assertIsNone(data.get_observation("2024_09_18_1950"))
+
+        observation = data.get_observation("2024_09_18_1940")
+        self.assertEqual(observation.station_id, "41001")
+        self.assertEqual(observation.timestamp, "2024_09_18_1940")
+        self.assertEqual(observation.lat_deg, 1.0)
+        self.assertEqual(observation.wind_speed_mps, 5.1)
+        self.assertEqual(observation.wind_direction_deg, 160.0)
+        self.assertIsNone(observation.wave_height_m)
+        self.assertIsNone(observation.tide_m)
+
+
 if __name__ == "__main__":
     unittest.main()